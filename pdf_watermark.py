@@ -9,23 +9,49 @@ https://github.com/marceloandrioni
 
 import os
 import sys
+import time
+import atexit
+import json
 import shutil
+import socket
 import tempfile
+import hashlib
 import argparse
+import multiprocessing
+from itertools import repeat
 from pathlib import Path
-import numpy as np
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from docx import Document
 from docx.shared import RGBColor, Mm, Pt
-from gooey import Gooey, GooeyParser
-from subprocess import Popen
-from pikepdf import Pdf, Page, Encryption, Permissions
+from subprocess import Popen, TimeoutExpired
+from pikepdf import (Pdf, Encryption, Permissions, AccessMode,
+                     ObjectStreamMode, Name, Rectangle)
 
-# @todo: try to use reportlab to convert the docx file to pdf, eleminating the need for libreoffice/word
-# https://stackoverflow.com/questions/77193084/docx-to-pdf-using-reportlab-without-using-application
+# used to lock the libreoffice profile
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
 
 # the docx conversion to pdf can be done with docx2pdf/word (windows only) or
 # using libreoffice (windows and linux)
 HAS_LIBREOFFICE = True if shutil.which('libreoffice') else False
+
+# the uno bridge (shipped with libreoffice) allows reusing a single running
+# libreoffice instance instead of starting a new one for each conversion
+try:
+
+    import uno
+    from com.sun.star.beans import PropertyValue
+    from com.sun.star.connection import NoConnectException
+
+    HAS_UNO = True
+
+except ImportError:
+
+    HAS_UNO = False
+
 try:
 
     # find Microsoft Word
@@ -41,18 +67,66 @@ except:
     HAS_DOCX2PDF = False
 
 
-# Use CLI (instead of GUI) if the CLI arguments were passed.
-# https://github.com/chriskiehl/Gooey/issues/449#issuecomment-534056010
+# libreoffice pdf export options (writer_pdf_Export filter data). The pdf file
+# is only used as watermark, so skip everything that makes it larger.
+LIBREOFFICE_PDF_OPTIONS = {'ExportBookmarks': False,
+                           'ExportNotes': False,
+                           'UseTaggedPDF': False,
+                           'ReduceImageResolution': True}
+
+
+# cached watermark pdf files not used for this long (in seconds) are removed
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+
+# Use CLI (instead of GUI) if the CLI arguments were passed. In this case Gooey
+# (and wx) is not even imported, since it takes a while to load.
 if len(sys.argv) > 1:
-    if '--ignore-gooey' not in sys.argv:
-        sys.argv.append('--ignore-gooey')
 
+    # no longer needed, but still accepted
+    if '--ignore-gooey' in sys.argv:
+        sys.argv.remove('--ignore-gooey')
+
+    def _ignore_gooey_options(container):
+        """Make add_argument of the parser/group (and of the groups created
+        from it) drop the Gooey only keyword arguments."""
 
-def create_wmark_docx(text):
+        add_argument = container.add_argument
+
+        def _add_argument(*args, widget=None, gooey_options=None, **kwargs):
+            return add_argument(*args, **kwargs)
+
+        def _wrap_group_factory(add_group):
+            def _add_group(*args, **kwargs):
+                return _ignore_gooey_options(add_group(*args, **kwargs))
+            return _add_group
+
+        container.add_argument = _add_argument
+        container.add_argument_group = _wrap_group_factory(
+            container.add_argument_group)
+        container.add_mutually_exclusive_group = _wrap_group_factory(
+            container.add_mutually_exclusive_group)
+
+        return container
+
+    def GooeyParser(*args, **kwargs):
+        return _ignore_gooey_options(argparse.ArgumentParser(*args, **kwargs))
+
+    def Gooey(*args, **kwargs):
+        return lambda func: func
+
+else:
+
+    from gooey import Gooey, GooeyParser
+
+
+def create_wmark_docx(text, folder=None):
 
     # create water mark file in temporary folder to overlay in main pdf file
-    wmark_docx = (Path(tempfile.gettempdir())
-                  / 'watermark_{:06d}.docx'.format(np.random.randint(1_000_000)))
+    fd, path = tempfile.mkstemp(prefix='watermark_', suffix='.docx',
+                                dir=folder)
+    os.close(fd)
+    wmark_docx = Path(path)
 
     # create docx
     document = Document()
@@ -88,21 +162,287 @@ def create_wmark_docx(text):
     return wmark_docx
 
 
+def is_winansi(text):
+    """Check if text can be written with the WinAnsi encoding, i.e. without
+    embedding a font in the pdf file."""
+
+    try:
+        encoded = text.encode('cp1252')
+    except UnicodeEncodeError:
+        return False
+
+    return all(32 <= byte != 127 for byte in encoded)
+
+
+def create_wmark_pdf(text, wmark_pdf):
+    """Create the A4 watermark pdf file with text as a red footer.
+
+    The pdf file is written directly with reportlab, which is much faster than
+    creating a docx file and converting it to pdf. Only WinAnsi text is
+    supported (see is_winansi).
+    """
+
+    # imported here, since reportlab takes a while to load and is not needed
+    # for pdf/docx watermarks
+    from reportlab.pdfgen import canvas
+    from reportlab.pdfbase.pdfmetrics import getDescent
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.colors import red
+    from reportlab.lib.units import mm
+
+    font_name, font_size = 'Helvetica', 12
+
+    c = canvas.Canvas(str(wmark_pdf), pagesize=A4)
+    c.setFont(font_name, font_size)
+    c.setFillColor(red)
+
+    # centered, with the descender 5 mm from the bottom of the page (same
+    # position as the footer in create_wmark_docx)
+    c.drawCentredString(A4[0] / 2,
+                        5 * mm - getDescent(font_name, font_size),
+                        text)
+
+    c.showPage()
+    c.save()
+
+
+def _try_lock(file):
+    """Try to lock an open file, without waiting. The lock is released when
+    the file is closed (or the process ends)."""
+
+    try:
+        if os.name == 'nt':
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+
+    return True
+
+
+@contextmanager
+def libreoffice_profile():
+    """Yield the url of the libreoffice user profile to use.
+
+    The profile in the cache folder is kept between runs, so the font cache
+    libreoffice builds on the first run is reused. Being exclusive to this
+    script, the conversion is also never handed off to a libreoffice instance
+    opened by the user, which would return before the pdf file is created.
+
+    The profile is locked while in use. If another run of this script is
+    using it, a temporary profile is used instead, for the same reason.
+    """
+
+    cache_dir = get_cache_dir()
+
+    with open(cache_dir / 'lo_profile.lock', 'a') as lock:
+        if _try_lock(lock):
+            profile = cache_dir / 'lo_profile'
+            profile.mkdir(parents=True, exist_ok=True)
+            yield profile.as_uri()
+            return
+
+    with tempfile.TemporaryDirectory(prefix='pdf_watermark_lo_') as profile:
+        yield Path(profile).as_uri()
+
+
+def _uno_property(name, value):
+
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+
+    return prop
+
+
+class LibreOfficeServer:
+    """Headless libreoffice instance listening on a socket.
+
+    Starting libreoffice takes a few seconds, so the same instance is kept
+    running and reused (through the uno bridge) for all the conversions.
+    """
+
+    def __init__(self, host='127.0.0.1', port=None, timeout=30):
+
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+        self._process = None
+        self._desktop = None
+        self._profile = None
+
+    @property
+    def connection(self):
+        return f'socket,host={self.host},port={self.port};urp;'
+
+    def start(self):
+
+        if self._process is not None:
+            return
+
+        # get libreoffice executable location
+        libre_office = shutil.which('libreoffice')
+        if not libre_office:
+            raise ValueError('Could not find libreoffice executable location '
+                             'in path.')
+
+        # use a free port, so we never connect to (and later terminate) a
+        # libreoffice instance started by someone else
+        if self.port is None:
+            with socket.socket() as sock:
+                sock.bind((self.host, 0))
+                self.port = sock.getsockname()[1]
+
+        # the profile is kept (locked) until the server is stopped
+        self._profile = ExitStack()
+        profile = self._profile.enter_context(libreoffice_profile())
+
+        try:
+            self._process = Popen([libre_office,
+                                   '--headless',
+                                   f'--accept={self.connection}',
+                                   '--norestore',
+                                   '--nologo',
+                                   '--nodefault',
+                                   '--nofirststartwizard',
+                                   f'-env:UserInstallation={profile}'])
+        except OSError:
+            self.stop()
+            raise
+
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local_context)
+
+        # wait for libreoffice to start accepting connections
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                context = resolver.resolve(
+                    f'uno:{self.connection}StarOffice.ComponentContext')
+                break
+            except NoConnectException:
+                if self._process.poll() is not None:
+                    # e.g. the job was handed off to another instance using
+                    # the same profile
+                    self.stop()
+                    raise RuntimeError('libreoffice exited before accepting '
+                                       'connections.')
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError('Could not connect to libreoffice.')
+                time.sleep(0.1)
+
+        self._desktop = context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.frame.Desktop', context)
+
+    def convert(self, input_docx, output_pdf):
+
+        self.start()
+
+        document = self._desktop.loadComponentFromURL(
+            Path(input_docx).resolve().as_uri(), '_blank', 0,
+            (_uno_property('Hidden', True),))
+
+        filter_data = uno.Any(
+            '[]com.sun.star.beans.PropertyValue',
+            tuple(_uno_property(name, value)
+                  for name, value in LIBREOFFICE_PDF_OPTIONS.items()))
+
+        try:
+            uno.invoke(document, 'storeToURL', (
+                Path(output_pdf).resolve().as_uri(),
+                (_uno_property('FilterName', 'writer_pdf_Export'),
+                 _uno_property('FilterData', filter_data))))
+        finally:
+            document.close(True)
+
+    def stop(self):
+
+        if self._process is None:
+            if self._profile is not None:
+                self._profile.close()
+                self._profile = None
+            return
+
+        # only terminate the instance started here, if it is still running
+        if self._process.poll() is None:
+            if self._desktop is not None:
+                try:
+                    self._desktop.terminate()
+                except:
+                    # the bridge is disposed as soon as libreoffice exits
+                    pass
+            else:
+                # never connected to it
+                self._process.kill()
+
+        try:
+            self._process.wait(timeout=self.timeout)
+        except TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+        self._process = None
+        self._desktop = None
+
+        self._profile.close()
+        self._profile = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+_libreoffice_server = None
+
+
+def get_libreoffice_server():
+    """Return the shared libreoffice server, started on first use and
+    stopped when the interpreter exits."""
+
+    global _libreoffice_server
+
+    if _libreoffice_server is None:
+        _libreoffice_server = LibreOfficeServer()
+        atexit.register(_libreoffice_server.stop)
+
+    return _libreoffice_server
+
+
 def libreoffice_docx2pdf(input_docx, out_folder):
     """Convert docx file to pdf using libreoffice.
     Reference: https://stackoverflow.com/a/56067358/9707202
     Author: https://stackoverflow.com/users/7037499/dfresh22
     """
 
+    if HAS_UNO:
+        output_pdf = Path(out_folder) / Path(input_docx).with_suffix('.pdf').name
+        get_libreoffice_server().convert(input_docx, output_pdf)
+        return
+
+    # no uno bridge, fall back to a one-off libreoffice process
+
     # get libreoffice executable location
     libre_office = shutil.which('libreoffice')
     if not libre_office:
         raise ValueError('Could not find libreoffice executable location in path.')
 
-    p = Popen([libre_office, '--headless', '--convert-to', 'pdf', '--outdir',
-               out_folder, input_docx])
-    # print([libre_office, '--convert-to', 'pdf', input_docx])
-    p.communicate()
+    options = json.dumps({name: {'type': 'boolean', 'value': str(value).lower()}
+                          for name, value in LIBREOFFICE_PDF_OPTIONS.items()})
+
+    with libreoffice_profile() as profile:
+        p = Popen([libre_office, '--headless',
+                   f'-env:UserInstallation={profile}',
+                   '--convert-to', f'pdf:writer_pdf_Export:{options}',
+                   '--outdir', out_folder, input_docx])
+        # print([libre_office, '--convert-to', 'pdf', input_docx])
+        p.communicate()
 
 
 def convert_docx_to_pdf(wmark_docx):
@@ -118,6 +458,212 @@ def convert_docx_to_pdf(wmark_docx):
     return wmark_pdf
 
 
+# folder returned by get_cache_dir
+_cache_dir = None
+
+
+def get_cache_dir():
+    """Folder used to keep files between runs.
+
+    If the folder can't be created or written (e.g. read only home folder), a
+    temporary folder, removed on exit, is used instead.
+    """
+
+    global _cache_dir
+
+    if _cache_dir is None:
+
+        cache_dir = (Path(os.environ.get('XDG_CACHE_HOME',
+                                         Path.home() / '.cache'))
+                     / 'pdf_watermark')
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            writable = os.access(cache_dir, os.W_OK)
+        except OSError:
+            writable = False
+
+        if not writable:
+            cache_dir = Path(tempfile.mkdtemp(prefix='pdf_watermark_'))
+            atexit.register(shutil.rmtree, cache_dir, ignore_errors=True)
+
+        _cache_dir = cache_dir
+
+    return _cache_dir
+
+
+def cached_wmark_pdf(text):
+    """Path of the cached watermark pdf file converted from the docx file
+    created from text."""
+
+    # the layout must be part of the key, so a change in create_wmark_docx
+    # does not reuse pdf files created with the old layout
+    layout = ('Arial', 12, 'A4', 25.4, 5)
+    key = hashlib.blake2b(repr((text, layout)).encode()).hexdigest()[:16]
+
+    return get_cache_dir() / f'watermark_{key}.pdf'
+
+
+def prune_cache():
+    """Remove the cached watermark pdf files not used in CACHE_MAX_AGE."""
+
+    oldest = time.time() - CACHE_MAX_AGE
+
+    for file in get_cache_dir().glob('watermark_*.pdf'):
+        try:
+            if file.stat().st_mtime < oldest:
+                file.unlink()
+        except OSError:
+            # e.g. already removed by a concurrent run
+            pass
+
+
+def temp_wmark_pdf():
+    """Path of a new empty temporary pdf file."""
+
+    fd, path = tempfile.mkstemp(prefix='watermark_', suffix='.pdf')
+    os.close(fd)
+
+    return Path(path)
+
+
+def wmark_form_xobject(pdf, wmark):
+    """Return the first page of the watermark pdf as a form xobject owned by
+    pdf, so a single copy is shared by all the pages."""
+
+    return pdf.copy_foreign(wmark.pages[0].as_form_xobject())
+
+
+class WatermarkOverlay:
+    """Add the watermark form xobject (already copied to pdf) on top of the
+    pages of pdf.
+
+    Same result as page.add_overlay(wmark_xobj), but the content streams that
+    place the watermark are only created once for each page size and shared
+    by the pages, and the page content streams are not coalesced (decoded,
+    joined and compressed again) after adding the watermark.
+    """
+
+    name = Name('/PdfWatermark')
+
+    def __init__(self, pdf, wmark_xobj):
+
+        self.pdf = pdf
+        self.wmark_xobj = wmark_xobj
+
+        self._push = pdf.make_stream(b'q\n')
+        self._placements = {}
+
+    def _placement(self, page):
+
+        rect = Rectangle(page.trimbox)
+        key = ((rect.llx, rect.lly, rect.urx, rect.ury),
+               page.get_matrix_for_transformations(invert=True).shorthand)
+
+        if key not in self._placements:
+            cs = page.calc_form_xobject_placement(self.wmark_xobj, self.name,
+                                                  rect,
+                                                  invert_transformations=True,
+                                                  allow_shrink=True,
+                                                  allow_expand=True)
+            # the page content streams are not coalesced, so the previous one
+            # may not end with a whitespace
+            self._placements[key] = self.pdf.make_stream(b'\nQ\n' + cs)
+
+        return self._placements[key]
+
+    def __call__(self, page):
+
+        # pages may share the resources dictionary, so the name may be already
+        # there. If it is used by something else (e.g. a file watermarked
+        # before) let pikepdf choose a new name.
+        existing = page.resources.get(Name.XObject, {}).get(self.name)
+        if existing is None:
+            page.add_resource(self.wmark_xobj, Name.XObject, self.name)
+        elif existing.objgen != self.wmark_xobj.objgen:
+            page.add_overlay(self.wmark_xobj)
+            return
+
+        page.contents_add(self._push, prepend=True)
+        page.contents_add(self._placement(page), prepend=False)
+
+
+def _mp_context():
+
+    # on linux, fork the workers instead of starting new interpreters that
+    # need to import all the modules again. Not when the libreoffice server
+    # was used: the uno bridge keeps threads running and forking a
+    # multithreaded process can deadlock.
+    if sys.platform.startswith('linux'):
+        if _libreoffice_server is None:
+            return multiprocessing.get_context('fork')
+        return multiprocessing.get_context('forkserver')
+
+    return None
+
+
+def save_pdf(pdf, outfile, linearize=False):
+
+    # Do not allow a regular user to modify the file.
+    # This way a user can't simply remove the watermark using a pdf editor like
+    # LibreOffice Draw.
+    allow = Permissions(accessibility=True,
+                        extract=True,
+                        modify_annotation=False,
+                        modify_assembly=False,
+                        modify_form=False,
+                        modify_other=False,
+                        print_lowres=True,
+                        print_highres=True)
+    # R=6 (AES-256) also allows saving with object streams
+    encryption = Encryption(user='', owner='admin123', allow=allow, R=6)
+
+    # group the small objects in compressed object streams. Skip the xmp
+    # metadata update and the pdf/a handling: the output is encrypted, so it
+    # can't be a pdf/a file anyway.
+    pdf.save(outfile,
+             linearize=linearize,
+             object_stream_mode=ObjectStreamMode.generate,
+             fix_metadata_version=False,
+             preserve_pdfa=False,
+             encryption=encryption)
+
+
+def _watermark_file(infile, outfile, wmark_pdf, linearize):
+    """Add the watermark to all the pages of a single file (batch mode)."""
+
+    with Pdf.open(wmark_pdf, access_mode=AccessMode.mmap) as wmark, \
+            Pdf.open(infile, access_mode=AccessMode.mmap) as pdf:
+
+        overlay = WatermarkOverlay(pdf, wmark_form_xobject(pdf, wmark))
+        for page in pdf.pages:
+            overlay(page)
+
+        save_pdf(pdf, outfile, linearize)
+
+    return outfile
+
+
+def watermark_dir(input_dir, output_dir, wmark_pdf, linearize):
+    """Add the watermark to all the pdf files in input_dir, in parallel
+    processes (one file per process), saving them in output_dir."""
+
+    infiles = sorted(input_dir.glob('*.pdf'))
+    outfiles = [output_dir / infile.name for infile in infiles]
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    total = len(infiles)
+    with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, total),
+                             mp_context=_mp_context()) as executor:
+
+        results = executor.map(_watermark_file, infiles, outfiles,
+                               repeat(wmark_pdf), repeat(linearize))
+
+        for i, outfile in enumerate(results, 1):
+            print(f'Output file: {outfile}')
+            print(f'File {i}/{total}')
+
+
 def user_args():
 
     description = 'Add a watermark to a pdf file.'
@@ -126,6 +672,7 @@ def user_args():
 
     parser.add_argument('infile',
                         type=lambda x: Path(x),
+                        nargs='?',
                         help='Input pdf file.',
                         widget='FileChooser',
                         gooey_options={
@@ -134,6 +681,7 @@ def user_args():
 
     parser.add_argument('outfile',
                         type=lambda x: Path(x),
+                        nargs='?',
                         help='Output pdf file.',
                         widget='FileSaver',
                         gooey_options={
@@ -169,22 +717,82 @@ def user_args():
                                   'wildcard': 'PDF file (*.pdf)|*.pdf',
                                   'message': 'Select watermark pdf file'})
 
+    group_batch = parser.add_argument_group(
+        title='Batch options',
+        description='Add the watermark to all the pdf files in a folder '
+                    '(instead of the input/output files).')
+
+    group_batch.add_argument('--input_dir',
+                             type=lambda x: Path(x),
+                             dest='input_dir',
+                             help='Folder with the input pdf files.',
+                             widget='DirChooser')
+
+    group_batch.add_argument('--output_dir',
+                             type=lambda x: Path(x),
+                             dest='output_dir',
+                             help='Folder for the output pdf files.',
+                             widget='DirChooser')
+
+    group_output = parser.add_argument_group(title='Output options')
+
+    group_output.add_argument('--linearize',
+                              action='store_true',
+                              help='Linearize ("fast web view") the output '
+                                   'pdf file. Slower, only useful for pdf '
+                                   'files served on the web.')
+
     args = parser.parse_args()
 
-    if not args.wmark_pdf and not any((HAS_LIBREOFFICE, HAS_DOCX2PDF)):
+    needs_conversion = (args.wmark_docx
+                        or (args.wmark_text
+                            and not is_winansi(args.wmark_text)
+                            and not cached_wmark_pdf(args.wmark_text).exists()))
+    if needs_conversion and not any((HAS_LIBREOFFICE, HAS_DOCX2PDF)):
         raise ValueError('libreoffice or docx2pdf/word must be installed to '
                          'create a pdf file from the watermark text.')
 
-    # additional checks in case user bypass Gooey to use argparse directly
-    if [args.infile.suffix, args.outfile.suffix] != ['.pdf', '.pdf']:
-        raise argparse.ArgumentTypeError('Input/Output files must be pdf files.')
+    if args.input_dir or args.output_dir:
+
+        if args.infile or args.outfile:
+            raise argparse.ArgumentTypeError('Input/Output files and folders '
+                                             "can't be used together.")
+
+        if not (args.input_dir and args.output_dir):
+            raise argparse.ArgumentTypeError('Both input and output folders '
+                                             'must be given.')
 
-    if not args.infile.exists():
-        raise argparse.ArgumentTypeError(f"Input file '{args.infile}' does "
-                                         "not exist.")
+        if not args.input_dir.is_dir():
+            raise argparse.ArgumentTypeError(f"Input folder '{args.input_dir}' "
+                                             "does not exist.")
 
-    if args.outfile.exists() and os.path.samefile(args.infile, args.outfile):
-        raise argparse.ArgumentTypeError("Input/Output files can't be the same.")
+        if not any(args.input_dir.glob('*.pdf')):
+            raise argparse.ArgumentTypeError('Input folder has no pdf files.')
+
+        if (args.output_dir.exists()
+                and os.path.samefile(args.input_dir, args.output_dir)):
+            raise argparse.ArgumentTypeError("Input/Output folders can't be the "
+                                             "same.")
+
+    else:
+
+        if not (args.infile and args.outfile):
+            raise argparse.ArgumentTypeError('Input/Output files must be '
+                                             'given.')
+
+        # additional checks in case user bypass Gooey to use argparse directly
+        if [args.infile.suffix, args.outfile.suffix] != ['.pdf', '.pdf']:
+            raise argparse.ArgumentTypeError('Input/Output files must be pdf '
+                                             'files.')
+
+        if not args.infile.exists():
+            raise argparse.ArgumentTypeError(f"Input file '{args.infile}' does "
+                                             "not exist.")
+
+        if (args.outfile.exists()
+                and os.path.samefile(args.infile, args.outfile)):
+            raise argparse.ArgumentTypeError("Input/Output files can't be the "
+                                             "same.")
 
     if args.wmark_docx and args.wmark_docx.suffix != '.docx':
         raise argparse.ArgumentTypeError('Watermark docx file must have .docx '
@@ -197,64 +805,121 @@ def user_args():
     return args
 
 
-@Gooey(required_cols=1,
-       default_size=(610, 800),
-       progress_regex=r"^Page (?P<current>\d+)/(?P<total>\d+)$",
-       progress_expr="current / total * 100")
-def main():
-
-    args = user_args()
+def prepare_wmark_pdf(args):
+    """Return the watermark pdf file for the user arguments."""
 
     # if wmark_pdf was given, just use it
     # if wmark_docx was given, convert to pdf and use it
-    # if wmark_text was given, create docx, convert to pdf and use it
+    # if wmark_text was given, create pdf directly (or, if the text needs
+    # other fonts, create docx and convert to pdf) and use it. Only the
+    # converted pdf is cached, so the same text is only converted once;
+    # creating the pdf directly takes about 1 ms.
     if args.wmark_pdf:
-        wmark_pdf = args.wmark_pdf
-    elif args.wmark_docx:
-        wmark_pdf = convert_docx_to_pdf(args.wmark_docx)
-    else:
-        wmark_docx = create_wmark_docx(args.wmark_text)
-        wmark_pdf = convert_docx_to_pdf(wmark_docx)
+        return args.wmark_pdf
+
+    if args.wmark_docx:
+        return convert_docx_to_pdf(args.wmark_docx)
+
+    if is_winansi(args.wmark_text):
+        wmark_pdf = temp_wmark_pdf()
+        create_wmark_pdf(args.wmark_text, wmark_pdf)
+        return wmark_pdf
+
+    wmark_pdf = cached_wmark_pdf(args.wmark_text)
+    if wmark_pdf.exists():
+        # mark as used, so prune_cache keeps it
+        try:
+            os.utime(wmark_pdf)
+        except OSError:
+            pass
+        return wmark_pdf
+
+    # the temporary docx/pdf files are removed even if the conversion fails
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        wmark_docx = create_wmark_docx(args.wmark_text, tmp_dir)
+        new_pdf = convert_docx_to_pdf(wmark_docx)
+
+        tmp_pdf = wmark_pdf.with_name(f'{wmark_pdf.stem}_{os.getpid()}.pdf')
+        try:
+            shutil.copy(new_pdf, tmp_pdf)
+            # rename only after the file was written, so a concurrent run
+            # never sees a partially written file
+            os.replace(tmp_pdf, wmark_pdf)
+        except OSError:
+            # e.g. full disk: use the pdf file without caching it
+            tmp_pdf.unlink(missing_ok=True)
+            wmark_pdf = temp_wmark_pdf()
+            shutil.copy(new_pdf, wmark_pdf)
+        else:
+            prune_cache()
+
+    return wmark_pdf
+
 
-    wmark = Pdf.open(wmark_pdf)
-    thumbnail = Page(wmark.pages[0])
+def watermark_single_file(args):
+    """Add the watermark to the input file and return the watermark pdf
+    file used."""
 
     print(f'Input file: {args.infile}')
 
-    pdf = Pdf.open(args.infile)
+    # create the watermark pdf file (it may need a slow docx to pdf
+    # conversion) while the input file is read
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_wmark = executor.submit(prepare_wmark_pdf, args)
+        future_pdf = executor.submit(Pdf.open, args.infile)
+        wmark_pdf = future_wmark.result()
+        pdf = future_pdf.result()
 
-    # merge water mark file with each page of input pdf file
-    for page in pdf.pages:
+    wmark = Pdf.open(wmark_pdf, access_mode=AccessMode.mmap)
+    wmark_xobj = wmark_form_xobject(pdf, wmark)
 
-        print(f'Page {page.index + 1}/{len(pdf.pages)}')
+    overlay = WatermarkOverlay(pdf, wmark_xobj)
 
-        page.add_overlay(thumbnail)
+    # merge water mark file with each page of input pdf file, reporting the
+    # progress at most ~100 times
+    total = len(pdf.pages)
+    step = max(1, total // 100)
+    for i, page in enumerate(pdf.pages, 1):
 
-    # Do not allow a regular user to modify the file.
-    # This way a user can't simply remove the watermark using a pdf editor like
-    # LibreOffice Draw.
-    allow = Permissions(accessibility=True,
-                        extract=True,
-                        modify_annotation=False,
-                        modify_assembly=False,
-                        modify_form=False,
-                        modify_other=False,
-                        print_lowres=True,
-                        print_highres=True)
-    encryption = Encryption(user='', owner='admin123', allow=allow)
+        overlay(page)
+
+        if i % step == 0 or i == total:
+            print(f'Page {i}/{total}')
 
     print(f'Output file: {args.outfile}')
-    pdf.save(args.outfile, linearize=True, encryption=encryption)
+    save_pdf(pdf, args.outfile, args.linearize)
 
     pdf.close()
 
     wmark.close()
 
-    # remove temporary files (keep template docx/pdf file given by user)
-    if args.wmark_text:
-        os.remove(wmark_docx)
-        os.remove(wmark_pdf)
-    elif args.wmark_docx:
+    return wmark_pdf
+
+
+@Gooey(required_cols=1,
+       default_size=(610, 800),
+       progress_regex=r"^(Page|File) (?P<current>\d+)/(?P<total>\d+)$",
+       progress_expr="current / total * 100")
+def main():
+
+    args = user_args()
+
+    if args.input_dir:
+
+        # the watermark pdf file is created once for all the files
+        wmark_pdf = prepare_wmark_pdf(args)
+
+        watermark_dir(args.input_dir, args.output_dir, wmark_pdf,
+                      args.linearize)
+
+    else:
+
+        wmark_pdf = watermark_single_file(args)
+
+    # remove temporary files (keep template docx/pdf file given by user and
+    # the cached watermark pdf)
+    if not args.wmark_pdf and wmark_pdf.parent != get_cache_dir():
         os.remove(wmark_pdf)
 
     print('Done!')